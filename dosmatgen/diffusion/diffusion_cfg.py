@@ -56,13 +56,13 @@ class SinusoidalTimeEmbeddings(nn.Module):
     def __init__(self, dim):
         super().__init__()
         self.dim = dim
+        half_dim = self.dim // 2
+        freqs = math.log(10000) / (half_dim - 1)
+        freqs = torch.exp(torch.arange(half_dim) * -freqs)
+        self.register_buffer('freqs', freqs, persistent=False)
 
     def forward(self, time):
-        device = time.device
-        half_dim = self.dim // 2
-        embeddings = math.log(10000) / (half_dim - 1)
-        embeddings = torch.exp(torch.arange(half_dim, device=device) * -embeddings)
-        embeddings = time[:, None] * embeddings[None, :]
+        embeddings = time[:, None] * self.freqs[None, :]
         embeddings = torch.cat((embeddings.sin(), embeddings.cos()), dim=-1)
         return embeddings
 
@@ -208,9 +208,9 @@ class CSPDiffusion(BaseModule):
     def sample(self, batch, diff_ratio=1.0, step_lr=1e-5, unconditional=False, conditional=False):
         batch_size = batch.num_graphs
 
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
+        l_T = torch.randn([batch_size, 3, 3], device=self.device)
+        x_T = torch.rand([batch.num_nodes, 3], device=self.device)
+        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM], device=self.device)
 
         if diff_ratio < 1:
             time_start = int(self.beta_scheduler.timesteps * diff_ratio)
@@ -246,9 +246,10 @@ class CSPDiffusion(BaseModule):
             }
         }
 
+        time_emb_table = self.time_embedding(torch.arange(time_start + 1, device=self.device))
+
         for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
+            time_emb = time_emb_table[t].expand(batch_size, -1)
             
             alphas = self.beta_scheduler.alphas[t]
             alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
@@ -344,9 +345,9 @@ class CSPDiffusion(BaseModule):
     def cfg_sample(self, batch, diff_ratio=1.0, step_lr=1e-5, w=1.0):
         batch_size = batch.num_graphs
 
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
+        l_T = torch.randn([batch_size, 3, 3], device=self.device)
+        x_T = torch.rand([batch.num_nodes, 3], device=self.device)
+        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM], device=self.device)
 
         if diff_ratio < 1:
             time_start = int(self.beta_scheduler.timesteps * diff_ratio)
@@ -382,9 +383,10 @@ class CSPDiffusion(BaseModule):
             }
         }
 
+        time_emb_table = self.time_embedding(torch.arange(time_start + 1, device=self.device))
+
         for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
+            time_emb = time_emb_table[t].expand(batch_size, -1)
             
             alphas = self.beta_scheduler.alphas[t]
             alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
@@ -516,9 +518,9 @@ class CSPDiffusion(BaseModule):
     def masked_cfg_sample(self, batch, mask, diff_ratio=1.0, step_lr=1e-5, w=1.0):
         batch_size = batch.num_graphs
 
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
+        l_T = torch.randn([batch_size, 3, 3], device=self.device)
+        x_T = torch.rand([batch.num_nodes, 3], device=self.device)
+        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM], device=self.device)
 
         if diff_ratio < 1:
             time_start = int(self.beta_scheduler.timesteps * diff_ratio)
@@ -554,9 +556,10 @@ class CSPDiffusion(BaseModule):
             }
         }
 
+        time_emb_table = self.time_embedding(torch.arange(time_start + 1, device=self.device))
+
         for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
+            time_emb = time_emb_table[t].expand(batch_size, -1)
 
             alphas = self.beta_scheduler.alphas[t]
             alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
@@ -652,9 +655,9 @@ class CSPDiffusion(BaseModule):
     def fix_sample(self, batch, diff_ratio=1.0, step_lr=1e-5, w=1.0, fix_atom_type=28):
         batch_size = batch.num_graphs
 
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
+        l_T = torch.randn([batch_size, 3, 3], device=self.device)
+        x_T = torch.rand([batch.num_nodes, 3], device=self.device)
+        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM], device=self.device)
 
         fix_t_T = F.one_hot(torch.tensor([fix_atom_type-1], device=self.device), num_classes=MAX_ATOMIC_NUM).float()
 
@@ -695,9 +698,10 @@ class CSPDiffusion(BaseModule):
             }
         }
 
+        time_emb_table = self.time_embedding(torch.arange(time_start + 1, device=self.device))
+
         for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
+            time_emb = time_emb_table[t].expand(batch_size, -1)
             
             alphas = self.beta_scheduler.alphas[t]
             alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
@@ -1,9 +1,17 @@
 from typing import Any
 
+import os
 import math
+import contextlib
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from scipy.optimize import linear_sum_assignment
+try:
+    from lap import lapjv
+except ImportError:
+    lapjv = None
 
 import torch
 import torch.nn as nn
@@ -81,16 +89,95 @@ class SinusoidalTimeEmbeddings(nn.Module):
     def __init__(self, dim):
         super().__init__()
         self.dim = dim
+        half_dim = self.dim // 2
+        freqs = math.log(10000) / (half_dim - 1)
+        freqs = torch.exp(torch.arange(half_dim) * -freqs)
+        self.register_buffer('freqs', freqs, persistent=False)
 
     def forward(self, time):
-        device = time.device
-        half_dim = self.dim // 2
-        embeddings = math.log(10000) / (half_dim - 1)
-        embeddings = torch.exp(torch.arange(half_dim, device=device) * -embeddings)
-        embeddings = time[:, None] * embeddings[None, :]
+        embeddings = time[:, None] * self.freqs[None, :]
         embeddings = torch.cat((embeddings.sin(), embeddings.cos()), dim=-1)
         return embeddings
 
+def _corrector_update(x_t, pred_x, sqrt_sigma_norm, step_size, std_x, rand_x):
+    pred_x = pred_x * sqrt_sigma_norm
+    return x_t - step_size * pred_x + std_x * rand_x
+
+def _predictor_update_x(x_t, pred_x, sqrt_sigma_norm, step_size, std_x, rand_x, grad_x, aug, mask=None):
+    pred_x = pred_x * sqrt_sigma_norm
+    if mask is not None:
+        grad_x = grad_x * mask
+    return x_t - step_size * pred_x - (std_x ** 2) * aug * grad_x + std_x * rand_x
+
+def _predictor_update(v_t, pred_v, c0, c1, sigmas, rand_v, grad_v=None, aug=1.0, mask=None):
+    v_t_minus_1 = c0 * (v_t - c1 * pred_v) + sigmas * rand_v
+    if grad_v is not None:
+        if mask is not None:
+            grad_v = grad_v * mask
+        v_t_minus_1 = v_t_minus_1 - (sigmas ** 2) * aug * grad_v
+    return v_t_minus_1
+
+def _sampler_updates(compile_updates=False):
+    """ Corrector and predictor update helpers, each fullgraph-compiled into one fused kernel when requested. """
+    updates = (_corrector_update, _predictor_update_x, _predictor_update)
+    if compile_updates:
+        updates = tuple(torch.compile(update, fullgraph=True) for update in updates)
+    return updates
+
+def _solve_assignment(cost):
+    """ Column assignment of each row of a square cost matrix; uses lap.lapjv when installed. """
+    if lapjv is not None:
+        return lapjv(np.ascontiguousarray(cost, dtype=np.float64), extend_cost=True)[1]
+    return linear_sum_assignment(cost)[1]
+
+def _solve_lap_index(probs_np, sizes):
+    """ Global reassignment index from the padded per-crystal probabilities. """
+    offsets = np.cumsum([0] + sizes[:-1])
+    costs = [-probs_np[st:st + size, :size] for st, size in zip(offsets, sizes)]
+    assignments = list(_lap_pool().map(_solve_assignment, costs))
+    return np.concatenate([st + assignment for st, assignment in zip(offsets, assignments)])
+
+# worker threads shared by every per-crystal solve; scipy's solver releases the GIL
+_LAP_POOL = None
+_LAP_POOL_LOCK = threading.Lock()
+
+def _lap_pool():
+    global _LAP_POOL
+    with _LAP_POOL_LOCK:
+        if _LAP_POOL is None:
+            _LAP_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='lap-solve')
+        return _LAP_POOL
+
+# one background worker for lap_async; solves run in submission order
+_LAP_EXECUTOR = None
+_LAP_EXECUTOR_LOCK = threading.Lock()
+
+def _lap_executor():
+    global _LAP_EXECUTOR
+    with _LAP_EXECUTOR_LOCK:
+        if _LAP_EXECUTOR is None:
+            _LAP_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lap')
+        return _LAP_EXECUTOR
+
+@torch.compile(dynamic=True)
+def _multinomial_theta(noised_atom_types, atom_probs, alpha, alpha_bar, num_classes):
+    theta = (alpha[:, None] * noised_atom_types + (1 - alpha[:, None]) / num_classes) * \
+            (alpha_bar[:, None] * atom_probs + (1 - alpha_bar[:, None]) / num_classes)
+    return theta / (theta.sum(dim=-1, keepdim=True) + 1e-8)
+
+@torch.compile(dynamic=True)
+def _type_kl(noised_atom_types, atom_probs_0, pred_atom_types, alpha, alpha_bar, num_classes):
+    pred_atom_probs = F.softmax(pred_atom_types, dim=-1)
+    # the noised-type factor is shared by theta and theta_hat
+    noised_factor = alpha[:, None] * noised_atom_types + (1 - alpha[:, None]) / num_classes
+    theta = noised_factor * (alpha_bar[:, None] * atom_probs_0 + (1 - alpha_bar[:, None]) / num_classes)
+    theta_hat = noised_factor * (alpha_bar[:, None] * pred_atom_probs + (1 - alpha_bar[:, None]) / num_classes)
+    theta = theta / (theta.sum(dim=-1, keepdim=True) + 1e-8)
+    theta_hat = theta_hat / (theta_hat.sum(dim=-1, keepdim=True) + 1e-8)
+    # same as F.kl_div(log(theta_hat + 1e-8), theta), including 0 * log(0) = 0
+    kldiv = torch.xlogy(theta, theta) - theta * torch.log(theta_hat + 1e-8)
+    return kldiv.sum(dim=-1).mean()
+
 class CSPProperty(BaseModule):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
@@ -109,6 +196,22 @@ class CSPProperty(BaseModule):
         self.time_embedding = SinusoidalTimeEmbeddings(self.time_dim)
         self.time_independent = self.hparams.diffusion.get('time_independent', False)
         print(f"Time independence: {self.time_independent}")
+        self.bf16_inference = self.hparams.diffusion.get('bf16_inference', False)
+        # sampler update helpers run eagerly unless compile_sampler is set, like the decoder's compile_layers
+        self.compile_sampler = self.hparams.diffusion.get('compile_sampler', False)
+        self._corrector_update, self._predictor_update_x, self._predictor_update = _sampler_updates(self.compile_sampler)
+
+        # predictor-corrector coefficient tables, keyed by (step_lr, device)
+        self._sampling_tables = {}
+
+    def _inference_autocast(self, decoder):
+        """
+        bf16 autocast for a decoder call in infer/sample; training precision is set on the Trainer.
+        A decoder built with bf16 already autocasts its own forward, so only fp32 decoders are wrapped.
+        """
+        if self.bf16_inference and not decoder.bf16:
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
 
     def forward(self, batch):
         batch_size = batch.num_graphs
@@ -131,14 +234,15 @@ class CSPProperty(BaseModule):
         rand_x = torch.randn_like(frac_coords)
 
         input_lattice = c0[:, None, None] * lattices + c1[:, None, None] * rand_l
-        sigmas_per_atom = sigmas.repeat_interleave(batch.num_atoms)[:, None]
+
+        # one gather broadcasts all per-graph coefficients to the atoms
+        coefs_per_atom = torch.stack([c0, c1, sigmas], dim=-1)[batch.batch]
+        c0_repeated, c1_repeated, sigmas_per_atom = coefs_per_atom.split(1, dim=-1)
         input_frac_coords = (frac_coords + sigmas_per_atom * rand_x) % 1.
 
         gt_atom_types_onehot = F.one_hot(batch.atom_types-1, num_classes=MAX_ATOMIC_NUM).float()
         rand_t = torch.randn_like(gt_atom_types_onehot)
 
-        c0_repeated = c0.repeat_interleave(batch.num_atoms)[:, None]
-        c1_repeated = c1.repeat_interleave(batch.num_atoms)[:, None]
         atom_type_probs = c0_repeated * gt_atom_types_onehot + c1_repeated * rand_t
 
         # time independence
@@ -179,30 +283,59 @@ class CSPProperty(BaseModule):
         input_frac_coords = batch.frac_coords
         input_lattice = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
 
-        pred_x, pred_l, pred_t, pred_graph, pred_node = self.decoder(
-            time_emb,
-            atom_type_probs,
-            input_frac_coords,
-            input_lattice,
-            batch.num_atoms,
-            batch.batch
-        )
+        with self._inference_autocast(self.decoder):
+            pred_x, pred_l, pred_t, pred_graph, pred_node = self.decoder(
+                time_emb,
+                atom_type_probs,
+                input_frac_coords,
+                input_lattice,
+                batch.num_atoms,
+                batch.batch
+            )
 
         if self.decoder.pred_graph_level:
-            return pred_graph, batch.y
+            return pred_graph.float(), batch.y
         elif self.decoder.pred_node_level:
-            return pred_node, batch.y
+            return pred_node.float(), batch.y
         else:
             raise ValueError("Invalid prediction level")
 
+    def _precompute_sampling_tables(self, step_lr):
+        """ Per-timestep sampling coefficients; entry t is used for the step t -> t-1. """
+        key = (step_lr, self.device)
+        if key not in self._sampling_tables:
+            alphas = self.beta_scheduler.alphas
+            alphas_cumprod = self.beta_scheduler.alphas_cumprod
+            sigmas_x = self.sigma_scheduler.sigmas
+            adjacent_sigmas_x = torch.cat([sigmas_x.new_zeros(1), sigmas_x[:-1]])
+
+            corrector_step = step_lr * (sigmas_x / self.sigma_scheduler.sigma_begin) ** 2
+            predictor_step = sigmas_x ** 2 - adjacent_sigmas_x ** 2
+
+            self._sampling_tables[key] = {
+                'c0' : 1.0 / torch.sqrt(alphas),
+                'c1' : (1 - alphas) / torch.sqrt(1 - alphas_cumprod),
+                'sqrt_sigma_norm' : torch.sqrt(self.sigma_scheduler.sigmas_norm),
+                'corrector_step' : corrector_step,
+                'corrector_std' : torch.sqrt(2 * corrector_step),
+                'predictor_step' : predictor_step,
+                'predictor_std' : torch.sqrt((adjacent_sigmas_x ** 2 * predictor_step) / (sigmas_x ** 2))
+            }
+        return self._sampling_tables[key]
+
     @torch.no_grad()
-    def sample(self, batch, uncod, diff_ratio=1.0, step_lr=1e-5, aug=1.0):
+    def sample(self, batch, uncod, diff_ratio=1.0, step_lr=1e-5, aug=1.0, mask=None):
+        """
+        Predictor-corrector denoising guided by the property gradient of self.decoder.
+        If mask is given, guidance on coordinates and types is restricted to the
+        masked atoms and the lattice is left unguided.
+        """
         assert self.time_independent == False, "Time independence is not supported for denoising; use self.infer()"
 
         batch_size = batch.num_graphs
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
+        l_T = torch.randn([batch_size, 3, 3], device=self.device)
+        x_T = torch.rand([batch.num_nodes, 3], device=self.device)
+        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM], device=self.device)
         
         if diff_ratio < 1:
             time_start = int(self.beta_scheduler.timesteps * diff_ratio)
@@ -224,96 +357,81 @@ class CSPProperty(BaseModule):
         else:
             time_start = self.beta_scheduler.timesteps
 
-        traj = {
-            time_start: {
-                'num_atoms' : batch.num_atoms,
-                'atom_types' : t_T,
-                'frac_coords' : x_T % 1.,
-                'lattices' : l_T
-            }
-        }
+        # trajectory buffers in output order: slot time_start - t holds step t
+        all_atom_types = t_T.new_empty((time_start + 1, *t_T.shape))
+        all_frac_coords = x_T.new_empty((time_start + 1, *x_T.shape))
+        all_lattices = l_T.new_empty((time_start + 1, *l_T.shape))
+
+        all_atom_types[0] = t_T
+        torch.remainder(x_T, 1., out=all_frac_coords[0])
+        all_lattices[0] = l_T
+
+        tables = self._precompute_sampling_tables(step_lr)
+        time_emb_table = self.time_embedding(torch.arange(time_start + 1, device=self.device))
+
+        # noise buffers refilled in place every step
+        noise_l = torch.empty_like(l_T)
+        noise_x = torch.empty_like(x_T)
+        noise_t = torch.empty_like(t_T)
 
         for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
+            time_emb = time_emb_table[t].expand(batch_size, -1)
 
             if self.hparams.diffusion.latent_dim > 0:            
                 raise NotImplementedError
 
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T)
-            
-            alphas = self.beta_scheduler.alphas[t]
-            alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
-
             sigmas = self.beta_scheduler.sigmas[t]
-            sigma_x = self.sigma_scheduler.sigmas[t]
-            sigma_norm = self.sigma_scheduler.sigmas_norm[t]
+            c0 = tables['c0'][t]
+            c1 = tables['c1'][t]
+            sqrt_sigma_norm = tables['sqrt_sigma_norm'][t]
 
-            c0 = 1.0 / torch.sqrt(alphas)
-            c1 = (1 - alphas) / torch.sqrt(1 - alphas_cumprod)
-            c2 = (1 - alphas) / torch.sqrt(alphas)
-
-            x_t = traj[t]['frac_coords']
-            l_t = traj[t]['lattices']
-            t_t = traj[t]['atom_types']
+            step = time_start - t
+            x_t = all_frac_coords[step]
+            l_t = all_lattices[step]
+            t_t = all_atom_types[step]
 
             # Corrector
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
-
-            step_size = step_lr * (sigma_x / self.sigma_scheduler.sigma_begin) ** 2
-            std_x = torch.sqrt(2 * step_size)
-
-            pred_x, pred_l, pred_t, _, _, = uncod.decoder(
-                time_emb, 
-                t_t, 
-                x_t, 
-                l_t, 
-                batch.num_atoms, 
-                batch.batch
+            rand_x = noise_x.normal_() if t > 1 else noise_x.zero_()
+
+            # only the coordinate score is used here; lattice and types move in the predictor
+            with self._inference_autocast(uncod.decoder):
+                pred_x, _, _, _, _, = uncod.decoder(
+                    time_emb, 
+                    t_t, 
+                    x_t, 
+                    l_t, 
+                    batch.num_atoms, 
+                    batch.batch
+                )
+
+            x_t_minus_05 = self._corrector_update(
+                x_t, pred_x, sqrt_sigma_norm, tables['corrector_step'][t], tables['corrector_std'][t], rand_x
             )
-
-            pred_x = pred_x * torch.sqrt(sigma_norm)
-            x_t_minus_05 = x_t - step_size * pred_x + std_x * rand_x
             l_t_minus_05 = l_t
             t_t_minus_05 = t_t
 
             # Predictor
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
-
-            adjacent_sigma_x = self.sigma_scheduler.sigmas[t-1] 
-            step_size = (sigma_x ** 2 - adjacent_sigma_x ** 2)
-            std_x = torch.sqrt((adjacent_sigma_x ** 2 * (sigma_x ** 2 - adjacent_sigma_x ** 2)) / (sigma_x ** 2))
-
-            pred_x, pred_l, pred_t, _, _, = uncod.decoder(
-                time_emb, 
-                t_t_minus_05, 
-                x_t_minus_05, 
-                l_t_minus_05, 
-                batch.num_atoms, 
-                batch.batch
-            )
+            rand_l = noise_l.normal_() if t > 1 else noise_l.zero_()
+            rand_t = noise_t.normal_() if t > 1 else noise_t.zero_()
+            rand_x = noise_x.normal_() if t > 1 else noise_x.zero_()
 
             with torch.enable_grad():
                 with RequiresGradContext(t_t_minus_05, x_t_minus_05, l_t_minus_05, requires_grad=True):
-                    _, _, _, pred_graph, pred_node = self.decoder(
-                        time_emb, 
-                        t_t_minus_05, 
-                        x_t_minus_05, 
-                        l_t_minus_05, 
-                        batch.num_atoms, 
-                        batch.batch
-                    )
-
+                    with self._inference_autocast(self.decoder):
+                        guided_x, guided_l, guided_t, pred_graph, pred_node = self.decoder(
+                            time_emb, 
+                            t_t_minus_05, 
+                            x_t_minus_05, 
+                            l_t_minus_05, 
+                            batch.num_atoms, 
+                            batch.batch
+                        )
+
+                    # guidance objective and its gradients stay in fp32
                     if self.decoder.pred_graph_level:
-                        val = torch.linalg.norm(pred_graph - batch.y, dim=1, keepdim=True)
+                        val = torch.linalg.norm(pred_graph.float() - batch.y, dim=1, keepdim=True)
                     elif self.decoder.pred_node_level:
-                        val = torch.linalg.norm(pred_node - batch.y, dim=1, keepdim=True)
+                        val = torch.linalg.norm(pred_node.float() - batch.y, dim=1, keepdim=True)
                     else:
                         raise ValueError("Invalid prediction level")
                     
@@ -325,137 +443,12 @@ class CSPProperty(BaseModule):
                         allow_unused=True
                     )
 
-            pred_x = pred_x * torch.sqrt(sigma_norm)
-            x_t_minus_1 = x_t_minus_05 - step_size * pred_x - (std_x ** 2) * aug * grad_x + std_x * rand_x 
-            l_t_minus_1 = c0 * (l_t_minus_05 - c1 * pred_l) - (sigmas ** 2) * aug * grad_l + sigmas * rand_l 
-            t_t_minus_1 = c0 * (t_t_minus_05 - c1 * pred_t) - (sigmas ** 2) * aug * grad_t + sigmas * rand_t
-
-            traj[t - 1] = {
-                'num_atoms' : batch.num_atoms,
-                'atom_types' : t_t_minus_1,
-                'frac_coords' : x_t_minus_1 % 1.,
-                'lattices' : l_t_minus_1
-            }
-
-        traj_stack = {
-            'num_atoms' : batch.num_atoms,
-            'atom_types' : torch.stack([traj[i]['atom_types'] for i in range(time_start, -1, -1)]).argmax(dim=-1) + 1,
-            'all_frac_coords' : torch.stack([traj[i]['frac_coords'] for i in range(time_start, -1, -1)]),
-            'all_lattices' : torch.stack([traj[i]['lattices'] for i in range(time_start, -1, -1)])
-        }
-
-        res = traj[0]
-        res['atom_types'] = res['atom_types'].argmax(dim=-1) + 1
-
-        return traj[0], traj_stack
-    
-    @torch.no_grad()
-    def masked_sample(self, batch, uncod, diff_ratio=1.0, step_lr=1e-5, aug=1.0, mask=None):
-        assert self.time_independent == False, "Time independence is not supported for denoising; use self.infer()"
-
-        batch_size = batch.num_graphs
-        l_T = torch.randn([batch_size, 3, 3]).to(self.device)
-        x_T = torch.rand([batch.num_nodes, 3]).to(self.device)
-        t_T = torch.randn([batch.num_nodes, MAX_ATOMIC_NUM]).to(self.device)
-        
-        if diff_ratio < 1:
-            time_start = int(self.beta_scheduler.timesteps * diff_ratio)
-            lattices = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
-            atom_types_onehot = F.one_hot(batch.atom_types-1, num_classes=MAX_ATOMIC_NUM).float()
-            frac_coords = batch.frac_coords
-            rand_l = torch.randn_like(lattices)
-            rand_x = torch.randn_like(frac_coords)
-            rand_t = torch.randn_like(atom_types_onehot)
-
-            alphas_cumprod = self.beta_scheduler.alphas_cumprod[time_start]
-            beta = self.beta_scheduler.betas[time_start]
-            c0 = torch.sqrt(alphas_cumprod)
-            c1 = torch.sqrt(1. - alphas_cumprod)
-            sigmas = self.sigma_scheduler.sigmas[time_start]
-            l_T = c0 * lattices + c1 * rand_l
-            x_T = (frac_coords + sigmas * rand_x) % 1.
-            t_T = c0 * atom_types_onehot + c1 * rand_t
-        else:
-            time_start = self.beta_scheduler.timesteps
-
-        traj = {
-            time_start: {
-                'num_atoms' : batch.num_atoms,
-                'atom_types' : t_T,
-                'frac_coords' : x_T % 1.,
-                'lattices' : l_T
-            }
-        }
-
-        for t in tqdm(range(time_start, 0, -1)):
-            times = torch.full((batch_size,), t, device=self.device)
-            time_emb = self.time_embedding(times)
-
-            if self.hparams.diffusion.latent_dim > 0:            
-                raise NotImplementedError
-
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T)
-            
-            alphas = self.beta_scheduler.alphas[t]
-            alphas_cumprod = self.beta_scheduler.alphas_cumprod[t]
-
-            sigmas = self.beta_scheduler.sigmas[t]
-            sigma_x = self.sigma_scheduler.sigmas[t]
-            sigma_norm = self.sigma_scheduler.sigmas_norm[t]
-
-            c0 = 1.0 / torch.sqrt(alphas)
-            c1 = (1 - alphas) / torch.sqrt(1 - alphas_cumprod)
-            c2 = (1 - alphas) / torch.sqrt(alphas)
-
-            x_t = traj[t]['frac_coords']
-            l_t = traj[t]['lattices']
-            t_t = traj[t]['atom_types']
-
-            # Corrector
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
-
-            step_size = step_lr * (sigma_x / self.sigma_scheduler.sigma_begin) ** 2
-            std_x = torch.sqrt(2 * step_size)
-
-            pred_x, pred_l, pred_t, _, _, = uncod.decoder(
-                time_emb, 
-                t_t, 
-                x_t, 
-                l_t, 
-                batch.num_atoms, 
-                batch.batch
-            )
-
-            pred_x = pred_x * torch.sqrt(sigma_norm)
-            x_t_minus_05 = x_t - step_size * pred_x + std_x * rand_x
-            l_t_minus_05 = l_t
-            t_t_minus_05 = t_t
-
-            # Predictor
-            rand_l = torch.randn_like(l_T) if t > 1 else torch.zeros_like(l_T)
-            rand_t = torch.randn_like(t_T) if t > 1 else torch.zeros_like(t_T)
-            rand_x = torch.randn_like(x_T) if t > 1 else torch.zeros_like(x_T)
-
-            adjacent_sigma_x = self.sigma_scheduler.sigmas[t-1] 
-            step_size = (sigma_x ** 2 - adjacent_sigma_x ** 2)
-            std_x = torch.sqrt((adjacent_sigma_x ** 2 * (sigma_x ** 2 - adjacent_sigma_x ** 2)) / (sigma_x ** 2))
-
-            pred_x, pred_l, pred_t, _, _, = uncod.decoder(
-                time_emb, 
-                t_t_minus_05, 
-                x_t_minus_05, 
-                l_t_minus_05, 
-                batch.num_atoms, 
-                batch.batch
-            )
-
-            with torch.enable_grad():
-                with RequiresGradContext(t_t_minus_05, x_t_minus_05, l_t_minus_05, requires_grad=True):
-                    _, _, _, pred_graph, pred_node = self.decoder(
+            if uncod is self:
+                # the guidance pass already ran the same decoder on the same inputs
+                pred_x, pred_l, pred_t = guided_x.detach(), guided_l.detach(), guided_t.detach()
+            else:
+                with self._inference_autocast(uncod.decoder):
+                    pred_x, pred_l, pred_t, _, _, = uncod.decoder(
                         time_emb, 
                         t_t_minus_05, 
                         x_t_minus_05, 
@@ -464,105 +457,106 @@ class CSPProperty(BaseModule):
                         batch.batch
                     )
 
-                    if self.decoder.pred_graph_level:
-                        val = torch.linalg.norm(pred_graph - batch.y, dim=1, keepdim=True)
-                    elif self.decoder.pred_node_level:
-                        val = torch.linalg.norm(pred_node - batch.y, dim=1, keepdim=True)
-                    else:
-                        raise ValueError("Invalid prediction level")
-                    
-                    grad_outputs = [torch.ones_like(val)]
-                    grad_t, grad_x, grad_l = grad(
-                        val, 
-                        [t_t_minus_05, x_t_minus_05, l_t_minus_05], 
-                        grad_outputs=grad_outputs, 
-                        allow_unused=True
-                    )
-            
-            assert len(mask) == grad_x.shape[0] == grad_t.shape[0]
-            grad_x = grad_x * mask
-            grad_t = grad_t * mask
-
-            pred_x = pred_x * torch.sqrt(sigma_norm)
-            x_t_minus_1 = x_t_minus_05 - step_size * pred_x - (std_x ** 2) * aug * grad_x + std_x * rand_x 
-            l_t_minus_1 = c0 * (l_t_minus_05 - c1 * pred_l) + sigmas * rand_l 
-            t_t_minus_1 = c0 * (t_t_minus_05 - c1 * pred_t) - (sigmas ** 2) * aug * grad_t + sigmas * rand_t
-
-            # x_t_minus_1 = x_t_minus_05 - step_size * pred_x - (std_x ** 2) * aug * grad_x + std_x * rand_x 
-            # l_t_minus_1 = c0 * (l_t_minus_05 - c1 * pred_l) - (sigmas ** 2) * aug * grad_l + sigmas * rand_l 
-            # t_t_minus_1 = c0 * (t_t_minus_05 - c1 * pred_t) - (sigmas ** 2) * aug * grad_t + sigmas * rand_t
-
-            traj[t - 1] = {
-                'num_atoms' : batch.num_atoms,
-                'atom_types' : t_t_minus_1,
-                'frac_coords' : x_t_minus_1 % 1.,
-                'lattices' : l_t_minus_1
-            }
+            if mask is not None:
+                grad_l = None
+
+            x_t_minus_1 = self._predictor_update_x(
+                x_t_minus_05, pred_x, sqrt_sigma_norm, tables['predictor_step'][t], tables['predictor_std'][t], rand_x, grad_x, aug, mask
+            )
+            l_t_minus_1 = self._predictor_update(l_t_minus_05, pred_l, c0, c1, sigmas, rand_l, grad_l, aug)
+            t_t_minus_1 = self._predictor_update(t_t_minus_05, pred_t, c0, c1, sigmas, rand_t, grad_t, aug, mask)
+
+            all_atom_types[step + 1] = t_t_minus_1
+            torch.remainder(x_t_minus_1, 1., out=all_frac_coords[step + 1])
+            all_lattices[step + 1] = l_t_minus_1
+
+        all_atom_types = all_atom_types.argmax(dim=-1) + 1
 
         traj_stack = {
             'num_atoms' : batch.num_atoms,
-            'atom_types' : torch.stack([traj[i]['atom_types'] for i in range(time_start, -1, -1)]).argmax(dim=-1) + 1,
-            'all_frac_coords' : torch.stack([traj[i]['frac_coords'] for i in range(time_start, -1, -1)]),
-            'all_lattices' : torch.stack([traj[i]['lattices'] for i in range(time_start, -1, -1)])
+            'atom_types' : all_atom_types,
+            'all_frac_coords' : all_frac_coords,
+            'all_lattices' : all_lattices
         }
 
-        res = traj[0]
-        res['atom_types'] = res['atom_types'].argmax(dim=-1) + 1
+        res = {
+            'num_atoms' : batch.num_atoms,
+            'atom_types' : all_atom_types[-1],
+            'frac_coords' : all_frac_coords[-1],
+            'lattices' : all_lattices[-1]
+        }
 
-        return traj[0], traj_stack
+        return res, traj_stack
+    
+    @torch.no_grad()
+    def masked_sample(self, batch, uncod, diff_ratio=1.0, step_lr=1e-5, aug=1.0, mask=None):
+        assert mask is not None and len(mask) == batch.num_nodes
+        return self.sample(batch, uncod, diff_ratio=diff_ratio, step_lr=step_lr, aug=aug, mask=mask)
 
-    def multinomial_sample(self, t_t, pred_t, num_atoms, times):
+    def multinomial_sample(self, t_t, pred_t, node2graph, times):
         noised_atom_types = t_t
         pred_atom_probs = F.softmax(pred_t, dim=-1)
 
-        alpha = self.beta_scheduler.alphas[times].repeat_interleave(num_atoms)
-        alpha_bar = self.beta_scheduler.alphas_cumprod[times-1].repeat_interleave(num_atoms)
+        alpha = self.beta_scheduler.alphas[times][node2graph]
+        alpha_bar = self.beta_scheduler.alphas_cumprod[times-1][node2graph]
 
-        theta = (alpha[:, None] * noised_atom_types + (1 - alpha[:, None]) / MAX_ATOMIC_NUM) * \
-                (alpha_bar[:, None] * pred_atom_probs + (1 - alpha_bar[:, None]) / MAX_ATOMIC_NUM)
-        theta = theta / (theta.sum(dim=-1, keepdim=True) + 1e-8)
-        return theta
+        return _multinomial_theta(noised_atom_types, pred_atom_probs, alpha, alpha_bar, MAX_ATOMIC_NUM)
 
     def type_loss(self, pred_atom_types, target_atom_types, noised_atom_types, batch, times):
-        pred_atom_probs = F.softmax(pred_atom_types, dim=-1)
         atom_probs_0 = F.one_hot(target_atom_types-1, num_classes=MAX_ATOMIC_NUM)
 
-        alpha = self.beta_scheduler.alphas[times].repeat_interleave(batch.num_atoms)
-        alpha_bar = self.beta_scheduler.alphas_cumprod[times-1].repeat_interleave(batch.num_atoms)
-
-        theta = (alpha[:, None] * noised_atom_types + (1 - alpha[:, None]) / MAX_ATOMIC_NUM) * \
-                (alpha_bar[:, None] * atom_probs_0 + (1 - alpha_bar[:, None]) / MAX_ATOMIC_NUM)
-        theta_hat = (alpha[:, None] * noised_atom_types + (1 - alpha[:, None]) / MAX_ATOMIC_NUM) * \
-                    (alpha_bar[:, None] * pred_atom_probs + (1 - alpha_bar[:, None]) / MAX_ATOMIC_NUM)
+        alpha = self.beta_scheduler.alphas[times][batch.batch]
+        alpha_bar = self.beta_scheduler.alphas_cumprod[times-1][batch.batch]
 
-        theta = theta / (theta.sum(dim=-1, keepdim=True) + 1e-8)
-        theta_hat = theta_hat / (theta_hat.sum(dim=-1, keepdim=True) + 1e-8)
-        theta_hat = torch.log(theta_hat + 1e-8)
+        return _type_kl(noised_atom_types, atom_probs_0, pred_atom_types, alpha, alpha_bar, MAX_ATOMIC_NUM)
 
-        kldiv = F.kl_div(
-            input=theta_hat, 
-            target=theta, 
-            reduction='none',
-            log_target=False
-        ).sum(dim=-1)
+    def _lap_probs(self, probs, types, num_atoms):
+        # a single sync for the crystal sizes; the split below works on host ints
+        sizes = num_atoms.tolist()
+        probs_crys = [
+            crys_probs[:, crys_types]
+            for crys_probs, crys_types in zip(torch.split(probs, sizes), torch.split(types - 1, sizes))
+        ]
 
-        return kldiv.mean()
+        # pad every crystal to the largest one so all rows go through a single softmax and copy
+        max_size = max(sizes)
+        probs_crys = torch.cat([
+            F.pad(crys, (0, max_size - size), value=float('-inf')) for crys, size in zip(probs_crys, sizes)
+        ])
+        return F.softmax(probs_crys, dim=-1).detach(), sizes
 
     def lap(self, probs, types, num_atoms):
-        types_1 = types - 1
-        atoms_end = torch.cumsum(num_atoms, dim=0)
-        atoms_begin = torch.zeros_like(num_atoms)
-        atoms_begin[1:] = atoms_end[:-1]
-        res_types = []
-        for st, ed in zip(atoms_begin, atoms_end):
-            types_crys = types_1[st:ed]
-            probs_crys = probs[st:ed]
-            probs_crys = probs_crys[:,types_crys]
-            probs_crys = F.softmax(probs_crys, dim=-1).detach().cpu().numpy()
-            assignment = linear_sum_assignment(-probs_crys)[1].astype(np.int32)
-            types_crys = types_crys[assignment] + 1
-            res_types.append(types_crys)
-        return torch.cat(res_types)
+        probs_crys, sizes = self._lap_probs(probs, types, num_atoms)
+        index = _solve_lap_index(probs_crys.cpu().numpy(), sizes)
+        return self.lap_apply(types, index)
+
+    @staticmethod
+    def lap_apply(types, index):
+        """ Reassigned types from a lap index; runs on the current stream of the calling thread. """
+        return types[torch.from_numpy(index).to(types.device)]
+
+    def lap_async(self, probs, types, num_atoms):
+        """
+        Non-blocking lap(). Returns a Future resolving to the reassignment index;
+        lap_apply(types, future.result()) gives the result of lap().
+        """
+        probs_crys, sizes = self._lap_probs(probs, types, num_atoms)
+
+        copied = None
+        if probs_crys.is_cuda:
+            probs_host = torch.empty(probs_crys.shape, dtype=probs_crys.dtype, pin_memory=True)
+            probs_host.copy_(probs_crys, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            probs_host = probs_crys
+
+        def solve():
+            if copied is not None:
+                copied.synchronize()
+            return _solve_lap_index(probs_host.numpy(), sizes)
+
+        return _lap_executor().submit(solve)
 
     def training_step(self, batch: Any, batch_idx: int) -> torch.Tensor:
         output_dict = self(batch)
@@ -3,8 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import math
-from einops import rearrange, repeat
-from torch_geometric.utils import scatter, dense_to_sparse
+import contextlib
+from torch_geometric.utils import scatter
+from torch_scatter import segment_coo
 
 from dosmatgen.utils.constants import MAX_ATOMIC_NUM
 from dosmatgen.utils.graphs import radius_graph_pbc, repeat_blocks
@@ -14,15 +15,45 @@ class SinusoidsEmbedding(nn.Module):
         super().__init__()
         self.n_frequencies = n_frequencies
         self.n_space = n_space
-        self.frequencies = 2 * math.pi * torch.arange(self.n_frequencies)
+        self.register_buffer(
+            "frequencies",
+            2 * math.pi * torch.arange(self.n_frequencies).view(1, 1, -1),
+            persistent=False
+        )
         self.dim = self.n_frequencies * 2 * self.n_space
 
     def forward(self, x):
-        emb = x.unsqueeze(-1) * self.frequencies[None, None, :].to(x.device)
-        emb = emb.reshape(-1, self.n_frequencies * self.n_space)
-        emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
-        return emb
+        emb = (x.unsqueeze(-1) * self.frequencies.to(x.dtype)).reshape(-1, self.n_frequencies * self.n_space)
+        if emb.requires_grad:
+            # out= variants do not support autograd
+            return torch.cat((emb.sin(), emb.cos()), dim=-1)
+        half = emb.shape[1]
+        out = emb.new_empty(emb.shape[0], 2 * half)
+        torch.sin(emb, out=out[:, :half])
+        torch.cos(emb, out=out[:, half:])
+        return out
     
+def _frac_diff(frac_coords, edge_index):
+    # wrapped difference of the endpoint coordinates; fused when traced by a compiled CSPLayer
+    return (frac_coords[edge_index[1]] - frac_coords[edge_index[0]]) % 1.
+
+def lattice_ip_flatten(lattices, ip=True):
+    """ Flattened lattice inner products (or raw lattices if not ip), one row per graph."""
+    lattice_ips = lattices @ lattices.transpose(-1,-2) if ip else lattices
+    return lattice_ips.view(-1, 9)
+
+def _edge_messages(edge_mlp, src_proj, dst_proj, dist_proj, edge_index):
+    # first edge_mlp Linear from its per-node projections, then the rest of the MLP
+    edge_features = src_proj[edge_index[0]] + dst_proj[edge_index[1]] + dist_proj
+    for module in list(edge_mlp)[1:]:
+        edge_features = module(edge_features)
+    return edge_features
+
+@torch.compiler.disable
+def _segment_mean(edge_features, index, dim_size):
+    # torch_scatter op kept out of the compiled graph; gen_edges returns edges sorted by source node
+    return segment_coo(edge_features, index, dim_size=dim_size, reduce='mean')
+
 class CSPLayer(nn.Module):
     """ Message passing layer for cspnet."""
     def __init__(
@@ -31,7 +62,8 @@ class CSPLayer(nn.Module):
         act_fn=nn.SiLU(),
         dis_emb=None,
         ln=False,
-        ip=True
+        ip=True,
+        compile_layer=False
     ):
         super(CSPLayer, self).__init__()
 
@@ -61,6 +93,11 @@ class CSPLayer(nn.Module):
 
         if self.ln:
             self.layer_norm = nn.LayerNorm(hidden_dim)
+
+        # compiled in place so layer norm, the MLPs and the residual fuse around the
+        # segment reduction, and state_dict keys stay unchanged
+        if compile_layer:
+            self.compile(dynamic=True)
     
     def edge_model(
         self, 
@@ -69,35 +106,35 @@ class CSPLayer(nn.Module):
         lattices, 
         edge_index, 
         edge2graph, 
-        frac_diff=None
+        frac_diff=None,
+        lattice_ips_nodes=None
     ):
-        hi, hj = node_features[edge_index[0]], node_features[edge_index[1]]
         if frac_diff is None:
-            xi, xj = frac_coords[edge_index[0]], frac_coords[edge_index[1]]
-            frac_diff = (xj - xi) % 1.
+            frac_diff = _frac_diff(frac_coords, edge_index)
         if self.dis_emb is not None:
             frac_diff = self.dis_emb(frac_diff)
-        if self.ip:
-            lattice_ips = lattices @ lattices.transpose(-1,-2)
-        else:
-            lattice_ips = lattices
-
-        lattice_ips_flatten = lattice_ips.view(-1, 9)
-        lattice_ips_flatten_edges = lattice_ips_flatten[edge2graph]
 
-        edges_input = torch.cat([hi, hj, lattice_ips_flatten_edges, frac_diff], dim=1)
-        edge_features = self.edge_mlp(edges_input)
+        # the first Linear over [hi, hj, lattice_ips, frac_diff] is split by input block, so
+        # the node and lattice terms are projected per node and only then gathered to edges
+        edge_in = self.edge_mlp[0]
+        weight_i, weight_j, weight_l, weight_d = edge_in.weight.split(
+            [self.hidden_dim, self.hidden_dim, 9, self.dis_dim], dim=1
+        )
+        src_proj = F.linear(node_features, weight_i, edge_in.bias)
+        dst_proj = F.linear(node_features, weight_j)
+        dist_proj = F.linear(frac_diff, weight_d)
+        if lattice_ips_nodes is not None:
+            src_proj = src_proj + F.linear(lattice_ips_nodes, weight_l)
+        else:
+            dist_proj = dist_proj + F.linear(lattice_ip_flatten(lattices, self.ip)[edge2graph], weight_l)
 
-        return edge_features
+        return _edge_messages(self.edge_mlp, src_proj, dst_proj, dist_proj, edge_index)
 
-    def node_model(self, node_features, edge_features, edge_index):
-        agg = scatter(
-            edge_features, 
-            edge_index[0], 
-            dim=0, 
-            reduce='mean', 
-            dim_size=node_features.shape[0]
-        )
+    def node_model(self, node_features, edge_features, edge_index, segment_index=None):
+        # int64 source index for torch_scatter, which does not take int32 indices
+        if segment_index is None:
+            segment_index = edge_index[0]
+        agg = _segment_mean(edge_features, segment_index, node_features.shape[0])
 
         agg = torch.cat([node_features, agg], dim=1)
         out = self.node_mlp(agg)
@@ -110,7 +147,9 @@ class CSPLayer(nn.Module):
         lattices, 
         edge_index, 
         edge2graph, 
-        frac_diff=None
+        frac_diff=None,
+        lattice_ips_nodes=None,
+        segment_index=None
     ):
         node_input = node_features
         if self.ln:
@@ -122,16 +161,19 @@ class CSPLayer(nn.Module):
             lattices, 
             edge_index, 
             edge2graph, 
-            frac_diff
+            frac_diff,
+            lattice_ips_nodes
         )
 
         node_output = self.node_model(
             node_features, 
             edge_features, 
-            edge_index
+            edge_index,
+            segment_index
         )
 
-        return node_input + node_output
+        # node_output may be bf16 under autocast; the residual stream stays in node_input's dtype
+        return node_input + node_output.to(node_input.dtype)
     
 class CSPNet(nn.Module):
     def __init__(
@@ -154,7 +196,11 @@ class CSPNet(nn.Module):
         pred_node_level=False,
         pred_dim=None,
         cfg=False,
-        cfg_prob=0.0
+        cfg_prob=0.0,
+        bf16=False,
+        symmetric_edges=True,
+        int32_index=False,
+        compile_layers=False
     ):
         super(CSPNet, self).__init__()
 
@@ -175,6 +221,14 @@ class CSPNet(nn.Module):
         self.pred_graph_level = pred_graph_level
         self.pred_node_level = pred_node_level
         self.pred_dim = pred_dim
+        # bf16 autocast over the message passing layers and output heads
+        self.bf16 = bf16
+        # knn only: symmetrize the radius graph (drops and adds counter-edges) before message passing
+        self.symmetric_edges = symmetric_edges
+        # int32 indices for the gathers in forward; torch_scatter reductions keep int64
+        self.int32_index = int32_index
+        # torch.compile each message passing layer
+        self.compile_layers = compile_layers
         self.cfg = cfg
         self.cfg_prob = cfg_prob
 
@@ -194,17 +248,17 @@ class CSPNet(nn.Module):
             self.dis_emb = SinusoidsEmbedding(n_frequencies=num_freqs)
         elif dis_emb == 'none':
             self.dis_emb = None
-        for i in range(0, num_layers):
-            self.add_module(
-                "csp_layer_%d" % i, 
-                CSPLayer(
-                    hidden_dim, 
-                    self.act_fn, 
-                    self.dis_emb, 
-                    ln=ln, 
-                    ip=ip
-                )
-            )            
+        self.csp_layers = nn.ModuleList([
+            CSPLayer(
+                hidden_dim, 
+                self.act_fn, 
+                self.dis_emb, 
+                ln=ln, 
+                ip=ip,
+                compile_layer=compile_layers
+            )
+            for _ in range(num_layers)
+        ])
 
         self.coord_out = nn.Linear(hidden_dim, 3, bias=False)
         self.lattice_out = nn.Linear(hidden_dim, 9, bias=False)
@@ -227,6 +281,14 @@ class CSPNet(nn.Module):
         if self.cfg:
             self.y_projection = nn.Linear(self.pred_dim, self.hidden_dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the layers moved into csp_layers use csp_layer_{i}.* keys
+        old_prefix = prefix + "csp_layer_"
+        for key in [k for k in state_dict if k.startswith(old_prefix)]:
+            layer, rest = key[len(old_prefix):].split(".", 1)
+            state_dict[prefix + "csp_layers.%s.%s" % (layer, rest)] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def select_symmetric_edges(self, tensor, mask, reorder_idx, inverse_neg):
         # Mask out counter-edges
         tensor_directed = tensor[mask]
@@ -254,22 +316,16 @@ class CSPNet(nn.Module):
 
         # Generate mask
         mask_sep_atoms = edge_index[0] < edge_index[1]
-        # Distinguish edges between the same (periodic) atom by ordering the cells
-        cell_earlier = (
-            (cell_offsets[:, 0] < 0)
-            | ((cell_offsets[:, 0] == 0) & (cell_offsets[:, 1] < 0))
-            | (
-                (cell_offsets[:, 0] == 0)
-                & (cell_offsets[:, 1] == 0)
-                & (cell_offsets[:, 2] < 0)
-            )
-        )
+        # Distinguish edges between the same (periodic) atom by ordering the cells.
+        # radius_graph_pbc only returns offsets in {-1, 0, 1}, so the packed key
+        # is negative exactly when the first nonzero offset is.
+        cell_earlier = (cell_offsets[:, 0] * 9 + cell_offsets[:, 1] * 3 + cell_offsets[:, 2]) < 0
         mask_same_atoms = edge_index[0] == edge_index[1]
         mask_same_atoms &= cell_earlier
         mask = mask_sep_atoms | mask_same_atoms
 
         # Mask out counter-edges
-        edge_index_new = edge_index[mask[None, :].expand(2, -1)].view(2, -1)
+        edge_index_new = edge_index[:, mask]
 
         # Concatenate counter-edges after normal edges
         edge_index_cat = torch.cat(
@@ -300,12 +356,15 @@ class CSPNet(nn.Module):
 
         # Reorder everything so the edges of every image are consecutive
         edge_index_new = edge_index_cat[:, edge_reorder_idx]
-        cell_offsets_new = self.select_symmetric_edges(
-            cell_offsets, mask, edge_reorder_idx, True
+        # cell offsets and edge vectors share the mask, sign and reorder index
+        offsets_vectors_new = self.select_symmetric_edges(
+            torch.cat([cell_offsets.to(edge_vector.dtype), edge_vector], dim=-1),
+            mask, edge_reorder_idx, True
         )
-        edge_vector_new = self.select_symmetric_edges(
-            edge_vector, mask, edge_reorder_idx, True
+        cell_offsets_new, edge_vector_new = offsets_vectors_new.split(
+            [cell_offsets.shape[-1], edge_vector.shape[-1]], dim=-1
         )
+        cell_offsets_new = cell_offsets_new.to(cell_offsets.dtype)
 
         return (
             edge_index_new,
@@ -316,10 +375,18 @@ class CSPNet(nn.Module):
 
     def gen_edges(self, num_atoms, frac_coords, lattices, node2graph):
         if self.edge_style == 'fc':
-            lis = [torch.ones(n,n, device=num_atoms.device) for n in num_atoms]
-            fc_graph = torch.block_diag(*lis)
-            fc_edges, _ = dense_to_sparse(fc_graph)
-            return fc_edges, (frac_coords[fc_edges[1]] - frac_coords[fc_edges[0]]) % 1.
+            # all atom pairs of each crystal, in the row-major order of the block-diagonal adjacency
+            num_edges = num_atoms * num_atoms
+            atoms_per_edge = num_atoms.repeat_interleave(num_edges)
+            node_offsets = (num_atoms.cumsum(0) - num_atoms).repeat_interleave(num_edges)
+            edge_offsets = (num_edges.cumsum(0) - num_edges).repeat_interleave(num_edges)
+            local = torch.arange(atoms_per_edge.shape[0], device=num_atoms.device) - edge_offsets
+            fc_edges = torch.stack([
+                local // atoms_per_edge + node_offsets,
+                local % atoms_per_edge + node_offsets
+            ])
+            fc_edge2graph = torch.arange(num_atoms.shape[0], device=num_atoms.device).repeat_interleave(num_edges)
+            return fc_edges, _frac_diff(frac_coords, fc_edges), fc_edge2graph
         elif self.edge_style == 'knn':
             lattice_nodes = lattices[node2graph]
             cart_coords = torch.einsum('bi,bij->bj', frac_coords, lattice_nodes)
@@ -339,254 +406,132 @@ class CSPNet(nn.Module):
             distance_vectors = frac_coords[j_index] - frac_coords[i_index]
             distance_vectors += to_jimages.float()
 
-            edge_index_new, _, _, edge_vector_new = self.reorder_symmetric_edges(
-                edge_index, 
-                to_jimages, 
-                num_bonds, 
-                distance_vectors
-            )
+            if self.symmetric_edges:
+                edge_index_new, _, num_bonds_new, edge_vector_new = self.reorder_symmetric_edges(
+                    edge_index, 
+                    to_jimages, 
+                    num_bonds, 
+                    distance_vectors
+                )
+            else:
+                edge_index_new, num_bonds_new, edge_vector_new = edge_index, num_bonds, distance_vectors
 
-            return edge_index_new, -edge_vector_new
+            # sort by source node for the segment reduction in CSPLayer.node_model;
+            # nodes of a graph are contiguous, so the edges stay grouped per graph
+            perm = torch.argsort(edge_index_new[0], stable=True)
+            knn_edge2graph = torch.arange(num_atoms.shape[0], device=num_atoms.device).repeat_interleave(num_bonds_new)
+            return edge_index_new[:, perm], -edge_vector_new[perm], knn_edge2graph
             
-    def forward(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None, unconditional=False, conditional=False):
+    def forward(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None, unconditional=False, conditional=False, mask=None):
+        # the conditioning decision (including the random cfg dropout) is made here; _forward is shared by all modes
         if unconditional:
-            return self.unconditional(t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=y)
-        if conditional:
-            return self.conditional(t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=y)
-
-        edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
-        edge2graph = node2graph[edges[0]]
-        if self.smooth:
-            node_features = self.node_embedding(atom_types)
+            use_y = False
+        elif conditional:
+            use_y = True
         else:
-            node_features = self.node_embedding(atom_types-1)
-
-        t_per_atom = t.repeat_interleave(num_atoms, dim=0)
-
-
-        # classifier-free guidance
-        if self.cfg:
-            r = (torch.rand(1) >= self.cfg_prob).item()
-            if r:
-                y = y.to(t_per_atom.dtype)
-                y_proj = self.y_projection(y)
-                node_features = node_features + y_proj
-            else:
-                pass
-
-        node_features = torch.cat([node_features, t_per_atom], dim=1)
-
-        node_features = self.atom_latent_emb(node_features)
-
-        for i in range(0, self.num_layers):
-            node_features = self._modules["csp_layer_%d" % i](
-                node_features, 
-                frac_coords, 
-                lattices, 
-                edges, 
-                edge2graph, 
-                frac_diff=frac_diff
-            )
-
-        if self.ln:
-            node_features = self.final_layer_norm(node_features)
-
-        # output heads
-        coord_out = None
-        lattice_out = None
-        type_out = None
-        graph_out = None
-        node_out = None
-
-        coord_out = self.coord_out(node_features)
-
-        # node level output
-        if self.pred_node_level:
-            node_out = self.node_out(node_features)
-
-        graph_features = scatter(node_features, node2graph, dim=0, reduce='mean')
+            use_y = self.cfg and (torch.rand(1) >= self.cfg_prob).item()
 
-        if self.pred_graph_level:
-            graph_out = self.graph_out(graph_features)
-
-        lattice_out = self.lattice_out(graph_features)
-        lattice_out = lattice_out.view(-1, 3, 3)
-
-        if self.ip:
-            lattice_out = torch.einsum('bij,bjk->bik', lattice_out, lattices)
-        if self.pred_type:
-            type_out = self.type_out(node_features)
-        
-        return coord_out, lattice_out, type_out, graph_out, node_out
+        return self._forward(
+            t, 
+            atom_types, 
+            frac_coords, 
+            lattices, 
+            num_atoms, 
+            node2graph, 
+            y=y if use_y else None, 
+            mask=mask
+        )
 
     def unconditional(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None):
-        edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
-        edge2graph = node2graph[edges[0]]
-        if self.smooth:
-            node_features = self.node_embedding(atom_types)
-        else:
-            node_features = self.node_embedding(atom_types-1)
-
-        t_per_atom = t.repeat_interleave(num_atoms, dim=0)
-
-        node_features = torch.cat([node_features, t_per_atom], dim=1)
+        return self.forward(t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=y, unconditional=True)
 
-        node_features = self.atom_latent_emb(node_features)
-
-        for i in range(0, self.num_layers):
-            node_features = self._modules["csp_layer_%d" % i](
-                node_features, 
-                frac_coords, 
-                lattices, 
-                edges, 
-                edge2graph, 
-                frac_diff=frac_diff
-            )
-
-        if self.ln:
-            node_features = self.final_layer_norm(node_features)
-
-        # output heads
-        coord_out = None
-        lattice_out = None
-        type_out = None
-        graph_out = None
-        node_out = None
-
-        coord_out = self.coord_out(node_features)
-
-        # node level output
-        if self.pred_node_level:
-            node_out = self.node_out(node_features)
-
-        graph_features = scatter(node_features, node2graph, dim=0, reduce='mean')
-
-        if self.pred_graph_level:
-            graph_out = self.graph_out(graph_features)
-
-        lattice_out = self.lattice_out(graph_features)
-        lattice_out = lattice_out.view(-1, 3, 3)
-
-        if self.ip:
-            lattice_out = torch.einsum('bij,bjk->bik', lattice_out, lattices)
-        if self.pred_type:
-            type_out = self.type_out(node_features)
-        
-        return coord_out, lattice_out, type_out, graph_out, node_out
-    
     def conditional(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None):
-        edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
-        edge2graph = node2graph[edges[0]]
-        if self.smooth:
-            node_features = self.node_embedding(atom_types)
-        else:
-            node_features = self.node_embedding(atom_types-1)
-
-        t_per_atom = t.repeat_interleave(num_atoms, dim=0)
-
-        y = y.to(t_per_atom.dtype)
-        y_proj = self.y_projection(y)
-        node_features = node_features + y_proj
-
-        node_features = torch.cat([node_features, t_per_atom], dim=1)
-
-        node_features = self.atom_latent_emb(node_features)
-
-        for i in range(0, self.num_layers):
-            node_features = self._modules["csp_layer_%d" % i](
-                node_features,
-                frac_coords,
-                lattices,
-                edges,
-                edge2graph,
-                frac_diff=frac_diff
-            )
-
-        if self.ln:
-            node_features = self.final_layer_norm(node_features)
-
-        # output heads
-        coord_out = None
-        lattice_out = None
-        type_out = None
-        graph_out = None
-        node_out = None
-
-        coord_out = self.coord_out(node_features)
-
-        # node level output
-        if self.pred_node_level:
-            node_out = self.node_out(node_features)
-
-        graph_features = scatter(node_features, node2graph, dim=0, reduce='mean')
-
-        if self.pred_graph_level:
-            graph_out = self.graph_out(graph_features)
-
-        lattice_out = self.lattice_out(graph_features)
-        lattice_out = lattice_out.view(-1, 3, 3)
-
-        if self.ip:
-            lattice_out = torch.einsum('bij,bjk->bik', lattice_out, lattices)
-        if self.pred_type:
-            type_out = self.type_out(node_features)
-
-        return coord_out, lattice_out, type_out, graph_out, node_out
+        return self.forward(t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=y, conditional=True)
 
     def masked_conditional(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None, mask=None):
-        edges, frac_diff = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
-        edge2graph = node2graph[edges[0]]
-        if self.smooth:
-            node_features = self.node_embedding(atom_types)
+        return self.forward(t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=y, conditional=True, mask=mask)
+
+    def _forward(self, t, atom_types, frac_coords, lattices, num_atoms, node2graph, y=None, mask=None):
+        edges, frac_diff, edge2graph = self.gen_edges(num_atoms, frac_coords, lattices, node2graph)
+        segment_index = edges[0]
+        gather_node2graph = node2graph
+        if self.int32_index:
+            edges, edge2graph, gather_node2graph = edges.int(), edge2graph.int(), node2graph.int()
+        # shared by every layer; kept in fp32 so they match the edge MLP weight under an outer autocast
+        with torch.autocast(device_type=frac_coords.device.type, enabled=False):
+            lattice_ips_nodes = lattice_ip_flatten(lattices.float(), self.ip)[gather_node2graph]
+
+        # nullcontext rather than enabled=False, which would switch off an autocast region of the caller
+        if self.bf16:
+            autocast = torch.autocast(device_type=frac_coords.device.type, dtype=torch.bfloat16)
         else:
-            node_features = self.node_embedding(atom_types-1)
-
-        t_per_atom = t.repeat_interleave(num_atoms, dim=0)
+            autocast = contextlib.nullcontext()
 
-        y = y.to(t_per_atom.dtype)
-        y_proj = self.y_projection(y) * mask  # zero out unconditioned atoms after projection
-        node_features = node_features + y_proj
+        with autocast:
+            # smooth models embed float type probabilities; otherwise atom_types are 1-based indices
+            atom_types_idx = atom_types if self.smooth else atom_types - 1
+            node_features = self.node_embedding(atom_types_idx)
 
-        node_features = torch.cat([node_features, t_per_atom], dim=1)
+            # classifier-free guidance; y is None when the pass is unconditional
+            if y is not None:
+                y = y.to(t.dtype)
+                y_proj = self.y_projection(y)
+                if mask is not None:
+                    y_proj = y_proj * mask  # zero out unconditioned atoms after projection
+                node_features = node_features + y_proj
 
-        node_features = self.atom_latent_emb(node_features)
+            # atom_latent_emb over [node_features, t]: project t once per graph and gather to the atoms
+            weight_h, weight_t = self.atom_latent_emb.weight.split([self.hidden_dim, self.latent_dim], dim=1)
+            node_features = F.linear(node_features, weight_h, self.atom_latent_emb.bias) + F.linear(t, weight_t)[gather_node2graph]
+
+            # the residual stream between layers stays in fp32
+            node_features = node_features.float()
+
+            for layer in self.csp_layers:
+                node_features = layer(
+                    node_features, 
+                    frac_coords, 
+                    lattices, 
+                    edges, 
+                    edge2graph, 
+                    frac_diff=frac_diff,
+                    lattice_ips_nodes=lattice_ips_nodes,
+                    segment_index=segment_index
+                )
 
-        for i in range(0, self.num_layers):
-            node_features = self._modules["csp_layer_%d" % i](
-                node_features,
-                frac_coords,
-                lattices,
-                edges,
-                edge2graph,
-                frac_diff=frac_diff
-            )
+            if self.ln:
+                node_features = self.final_layer_norm(node_features)
 
-        if self.ln:
-            node_features = self.final_layer_norm(node_features)
+            # output heads
+            coord_out = None
+            lattice_out = None
+            type_out = None
+            graph_out = None
+            node_out = None
 
-        coord_out = None
-        lattice_out = None
-        type_out = None
-        graph_out = None
-        node_out = None
+            coord_out = self.coord_out(node_features)
 
-        coord_out = self.coord_out(node_features)
+            # node level output
+            if self.pred_node_level:
+                node_out = self.node_out(node_features)
 
-        if self.pred_node_level:
-            node_out = self.node_out(node_features)
+            graph_features = scatter(node_features, node2graph, dim=0, reduce='mean')
 
-        graph_features = scatter(node_features, node2graph, dim=0, reduce='mean')
+            if self.pred_graph_level:
+                graph_out = self.graph_out(graph_features)
 
-        if self.pred_graph_level:
-            graph_out = self.graph_out(graph_features)
+            lattice_out = self.lattice_out(graph_features)
+            lattice_out = lattice_out.view(-1, 3, 3)
 
-        lattice_out = self.lattice_out(graph_features)
-        lattice_out = lattice_out.view(-1, 3, 3)
+            if self.ip:
+                lattice_out = torch.einsum('bij,bjk->bik', lattice_out, lattices)
+            if self.pred_type:
+                type_out = self.type_out(node_features)
 
-        if self.ip:
-            lattice_out = torch.einsum('bij,bjk->bik', lattice_out, lattices)
-        if self.pred_type:
-            type_out = self.type_out(node_features)
+        if self.bf16:
+            coord_out, lattice_out, type_out, graph_out, node_out = (
+                out.float() if out is not None else None
+                for out in (coord_out, lattice_out, type_out, graph_out, node_out)
+            )
 
         return coord_out, lattice_out, type_out, graph_out, node_out
-